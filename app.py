@@ -1,10 +1,12 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 import numpy as np
-from utils.search_engine import ProductSearchEngine
-from utils.database import MongoDBConnection
+from utils.search_engine import ProductSearchEngine, _first_row_of
+from utils.database import DISPLAY_FIELDS, EmbeddingCache, MongoDBConnection
 import warnings
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from dotenv import load_dotenv
@@ -32,41 +34,130 @@ if not MONGO_CONNECTION_STRING:
 
 MONGO_DATABASE_NAME = os.getenv('MONGO_DATABASE_NAME', 'IPS')
 
-# Función para cargar datos con caché
-@st.cache_data(ttl=3600)  # Cache por 1 hora
-def load_data_from_mongodb():
-    """Carga los datos de productos y embeddings desde MongoDB"""
-    try:
-        # Crear conexión
-        mongo_conn = MongoDBConnection(MONGO_CONNECTION_STRING, MONGO_DATABASE_NAME)
+# Cuantización int8 de los índices FAISS (opcional)
+QUANTIZE_EMBEDDINGS = os.getenv('QUANTIZE_EMBEDDINGS', 'false').lower() == 'true'
+
+# Embeddings en float16 en memoria y en los índices FAISS (opcional)
+HALF_PRECISION_EMBEDDINGS = os.getenv('HALF_PRECISION_EMBEDDINGS', 'false').lower() == 'true'
+
+# Conexión a MongoDB compartida entre sesiones
+@st.cache_resource
+def get_mongo_connection():
+    """
+    Crea la conexión a MongoDB usada por la aplicación.
 
-        # Conectar a MongoDB
-        if not mongo_conn.connect():
-            st.error("No se pudo establecer conexión con MongoDB")
-            return None, None
+    El MongoClient mantiene su pool de conexiones durante la vida del proceso,
+    por lo que no se cierra después de cada carga de datos.
+    """
+    mongo_conn = MongoDBConnection(MONGO_CONNECTION_STRING, MONGO_DATABASE_NAME)
 
-        with st.spinner("Cargando productos desde MongoDB..."):
-            df_products = mongo_conn.get_products()
+    if not mongo_conn.connect():
+        # Una conexión fallida no se guarda en caché
+        raise ConnectionError("No se pudo establecer conexión con MongoDB")
 
-        with st.spinner("Cargando embeddings desde MongoDB..."):
-            df_embeddings = mongo_conn.get_embeddings()
+    return mongo_conn
 
-        # Cerrar conexión
-        mongo_conn.disconnect()
+# Función para cargar datos con caché
+@st.cache_resource(ttl=3600)  # Cache por 1 hora
+def load_data_from_mongodb():
+    """
+    Carga los datos de productos y embeddings desde MongoDB.
+
+    Se usa st.cache_resource para compartir los mismos objetos entre ejecuciones:
+    st.cache_data copiaría la matriz de embeddings (y la leería completa si viene
+    de la caché en disco) cada vez que se llama.
+    """
+    try:
+        # Reutilizar la conexión compartida
+        try:
+            mongo_conn = get_mongo_connection()
+        except ConnectionError as e:
+            st.error(str(e))
+            return None, None, None
+
+        # Productos y embeddings están en colecciones distintas: se descargan a la vez.
+        # Los hilos reciben el contexto de la ejecución para poder usar st.error/st.warning
+        ctx = get_script_run_ctx()
+        with st.spinner("Cargando catálogo…"):
+            with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx,
+                                    initargs=(None, ctx)) as executor:
+                future_products = executor.submit(mongo_conn.get_products, fields=DISPLAY_FIELDS)
+                future_embeddings = executor.submit(EmbeddingCache().load_or_fetch, mongo_conn)
+                df_products = future_products.result()
+                df_embeddings, embeddings = future_embeddings.result()
 
         if df_products.empty or df_embeddings.empty:
             st.error("No se pudieron cargar los datos desde MongoDB")
-            return None, None
+            return None, None, None
 
-        return df_products, df_embeddings
+        return df_products, df_embeddings, embeddings
 
     except Exception as e:
         st.error(f"Error al conectar con MongoDB: {e}")
-        return None, None
+        return None, None, None
+
+# Motor de búsqueda con los índices FAISS construidos al cargar los datos
+@st.cache_resource(max_entries=1, show_spinner="Construyendo índices de búsqueda...")
+def get_search_engine(data_key, _df_embeddings, _embeddings, _df_products):
+    """
+    Crea el motor de búsqueda y construye los índices FAISS de todos los clústeres.
+
+    Los datos llevan guion bajo para que Streamlit no calcule el hash de la matriz
+    de embeddings en cada ejecución; la caché se identifica por data_key, el id()
+    de los datos retornados por load_data_from_mongodb. El motor recibe también
+    df_products para agregar los detalles de los resultados desde memoria.
+    """
+    # Los índices se guardan junto a la caché de embeddings, que cambia con los datos
+    try:
+        index_dir = os.path.join(EmbeddingCache().get_cache_path(get_mongo_connection()), 'indexes')
+    except ConnectionError:
+        index_dir = None
+
+    search_engine = ProductSearchEngine(
+        quantize=QUANTIZE_EMBEDDINGS,
+        half_precision=HALF_PRECISION_EMBEDDINGS,
+        index_dir=index_dir
+    )
+    search_engine.prepare(_df_embeddings, _embeddings, _df_products)
+    search_engine.build_indexes()
+    return search_engine
+
+# Posición de cada producto en df_products
+@st.cache_resource(max_entries=1)
+def build_pid_index(data_key, _product_ids):
+    """
+    Crea un diccionario product_id -> posición de la fila en df_products.
+
+    La columna lleva guion bajo para que Streamlit no calcule su hash en cada ejecución;
+    la caché se identifica por data_key, el id() de df_products.
+    """
+    return _first_row_of(_product_ids)
+
+# Estadísticas del catálogo, calculadas una vez por cada carga de datos
+@st.cache_data(max_entries=1, hash_funcs={pd.DataFrame: lambda df: id(df)})
+def catalog_stats(df_products, df_embeddings):
+    """
+    Calcula el total de productos, de embeddings y de tiendas disponibles.
+
+    load_data_from_mongodb retorna los mismos DataFrames en cada ejecución, por lo
+    que se identifican por id() en lugar de calcular un hash de su contenido.
+    """
+    num_stores = df_products['data_source'].nunique() if 'data_source' in df_products.columns else 0
+    return len(df_products), len(df_embeddings), num_stores
 
 # Función para formatear el precio
 def format_price(price):
-    """Formatea el precio con separador de miles"""
+    """
+    Formatea el precio con separador de miles.
+
+    Acepta un valor o una pd.Series; las series se formatean de forma vectorizada
+    y se retorna una pd.Series de strings.
+    """
+    if isinstance(price, pd.Series):
+        prices = pd.to_numeric(price, errors='coerce')
+        formatted = prices.map("${:,.2f}".format, na_action='ignore')
+        return formatted.fillna("Precio no disponible")
+
     try:
         if pd.isna(price) or price is None:
             return "Precio no disponible"
@@ -74,13 +165,26 @@ def format_price(price):
     except:
         return "Precio no disponible"
 
+# Función para validar los campos de un producto
+def is_present(value):
+    """Indica si un valor tiene contenido: no es None, NaN, NA ni un string vacío"""
+    if value is None or value is pd.NA:
+        return False
+    if isinstance(value, str):
+        return bool(value.strip())
+    # NaN es distinto de sí mismo
+    return value == value
+
 # Función para mostrar tarjeta de producto
 def display_product_card(product, show_score=False, card_index=0):
-    """Muestra una tarjeta de producto con su información"""
+    """Muestra una tarjeta de producto con su información (pd.Series o dict)"""
+    if isinstance(product, pd.Series):
+        product = product.to_dict()
+
     col1, col2 = st.columns([1, 3])
 
     with col1:
-        if 'image' in product and pd.notna(product['image']):
+        if is_present(product.get('image')):
             try:
                 st.image(product['image'], width='stretch')
             except:
@@ -91,12 +195,12 @@ def display_product_card(product, show_score=False, card_index=0):
     with col2:
         # Validar nombre del producto
         product_name = "Producto sin nombre"
-        if 'product_name' in product and pd.notna(product['product_name']) and str(product['product_name']).strip():
+        if is_present(product.get('product_name')):
             product_name = str(product['product_name'])
 
         st.subheader(product_name)
 
-        if show_score and 'score' in product and pd.notna(product['score']):
+        if show_score and is_present(product.get('score')):
             try:
                 score_value = float(product['score'])
                 st.metric("Similitud", f"{score_value:.2%}")
@@ -107,7 +211,7 @@ def display_product_card(product, show_score=False, card_index=0):
         if 'sale_price' in product:
             st.metric("Precio", format_price(product['sale_price']))
 
-        if 'product_desc' in product and pd.notna(product['product_desc']) and str(product['product_desc']).strip():
+        if is_present(product.get('product_desc')):
             # Limpiar descripción HTML
             desc = str(product['product_desc']).replace('<p>', '').replace('</p>', '')
             # Generar un key único usando el ID del producto y el índice
@@ -121,10 +225,10 @@ def display_product_card(product, show_score=False, card_index=0):
                         disabled=True,
                         key=unique_key)
 
-        if 'data_source' in product and pd.notna(product['data_source']):
+        if is_present(product.get('data_source')):
             st.info(f"Tienda: {product['data_source']}")
 
-        if 'url' in product and pd.notna(product['url']) and str(product['url']).strip():
+        if is_present(product.get('url')):
             st.link_button("🛒 Ver en tienda", product['url'], type="primary")
 
 def main():
@@ -133,17 +237,14 @@ def main():
     st.markdown("---")
 
     # Cargar datos desde MongoDB
-    df_products, df_embeddings = load_data_from_mongodb()
+    df_products, df_embeddings, embeddings = load_data_from_mongodb()
 
     if df_products is None or df_embeddings is None:
         st.stop()
 
     # Inicializar motor de búsqueda
-    @st.cache_resource
-    def get_search_engine():
-        return ProductSearchEngine()
-
-    search_engine = get_search_engine()
+    search_engine = get_search_engine(id(df_embeddings), df_embeddings, embeddings, df_products)
+    pid_to_row = build_pid_index(id(df_products), df_products['product_id'])
 
     # Sidebar para configuración
     with st.sidebar:
@@ -172,9 +273,10 @@ def main():
 
         st.markdown("---")
         st.header("Estadísticas")
-        st.metric("Total de productos", f"{len(df_products):,}")
-        st.metric("Total de embeddings", f"{len(df_embeddings):,}")
-        st.metric("Tiendas disponibles", df_products['data_source'].nunique() if 'data_source' in df_products.columns else 0)
+        num_products, num_embeddings, num_stores = catalog_stats(df_products, df_embeddings)
+        st.metric("Total de productos", f"{num_products:,}")
+        st.metric("Total de embeddings", f"{num_embeddings:,}")
+        st.metric("Tiendas disponibles", num_stores)
 
         st.markdown("---")
         st.info("Conectado a MongoDB")
@@ -212,12 +314,12 @@ def main():
 
         # Si se presionó el botón de búsqueda (o Enter) y hay texto
         if search_submitted and search_query:
-            # Filtrar productos por nombre
-            filtered_products = df_products[
-                df_products['product_name'].str.contains(
-                    search_query, case=False, na=False
-                )
-            ].head(10)
+            # Buscar productos por nombre en MongoDB
+            try:
+                filtered_products = get_mongo_connection().search_products_by_name(search_query, limit=10)
+            except ConnectionError as e:
+                st.error(str(e))
+                filtered_products = pd.DataFrame()
 
             # Guardar resultados en session state
             if not filtered_products.empty:
@@ -236,9 +338,10 @@ def main():
             col1, col2 = st.columns([3, 1])
 
             with col1:
-                product_options = filtered_products.apply(
-                    lambda x: f"{x['product_name']} - {format_price(x['sale_price'])} ({x['data_source']})",
-                    axis=1
+                product_options = (
+                    filtered_products['product_name'].map(str) + " - " +
+                    format_price(filtered_products['sale_price']) + " (" +
+                    filtered_products['data_source'].map(str) + ")"
                 ).tolist()
 
                 selected_index = st.selectbox(
@@ -282,22 +385,21 @@ def main():
     if search_button and selected_product_id:
         with st.spinner("Buscando productos similares..."):
             # Verificar que el producto existe
-            if selected_product_id not in df_products['product_id'].values:
+            selected_row = pid_to_row.get(selected_product_id)
+
+            if selected_row is None:
                 st.error("El ID del producto no existe en la base de datos")
             else:
                 # Obtener información del producto seleccionado
-                selected_product = df_products[
-                    df_products['product_id'] == selected_product_id
-                ].iloc[0]
+                selected_product = df_products.iloc[selected_row]
 
                 # Mostrar producto seleccionado
                 st.markdown("---")
                 st.subheader("Producto Seleccionado")
                 display_product_card(selected_product, card_index=0)
 
-                # Buscar productos similares
+                # Buscar productos similares; los detalles se toman de df_products, ya en memoria
                 similar_products = search_engine.get_similar_products_with_details(
-                    df_embeddings,
                     df_products,
                     selected_product_id,
                     num_similar_products=num_results,
@@ -317,7 +419,9 @@ def main():
 
                     for tab, (store, products) in zip(tabs, grouped):
                         with tab:
-                            for idx, (_, product) in enumerate(products.iterrows()):
+                            # Convertir las filas a diccionarios de una sola vez
+                            records = products.to_dict('records')
+                            for idx, product in enumerate(records):
                                 with st.container():
                                     display_product_card(product, show_score=True, card_index=idx)
                                     if idx < len(products) - 1:
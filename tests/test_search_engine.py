@@ -0,0 +1,114 @@
+import faiss
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils.search_engine as search_engine
+from utils.search_engine import ProductSearchEngine
+
+# Umbral reducido para que las pruebas construyan clústeres pequeños a ambos lados de él
+HNSW_MIN_CLUSTER_SIZE = 200
+
+# Tamaño de cada clúster: por debajo del umbral (un índice) y por encima (un índice por tienda)
+CLUSTER_SIZES = {0: 190, 1: 230}
+
+# Proporción de productos de cada tienda; las últimas tienen muy pocos productos
+SOURCES = ('A', 'B', 'C', 'D')
+SOURCE_WEIGHTS = (0.8, 0.15, 0.04, 0.01)
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    """Embeddings normalizados con tiendas de tamaños muy distintos en cada clúster"""
+    monkeypatch.setattr(search_engine, 'HNSW_MIN_CLUSTER_SIZE', HNSW_MIN_CLUSTER_SIZE)
+
+    rng = np.random.default_rng(7)
+    cluster_ids = np.repeat(list(CLUSTER_SIZES), list(CLUSTER_SIZES.values()))
+    embeddings = rng.normal(size=(cluster_ids.size, 16)).astype(np.float32)
+    faiss.normalize_L2(embeddings)
+
+    df = pd.DataFrame({
+        'product_id': [f'p{i}' for i in range(cluster_ids.size)],
+        'cluster_id': cluster_ids,
+        'data_source': rng.choice(SOURCES, size=cluster_ids.size, p=SOURCE_WEIGHTS)
+    })
+    return df, embeddings
+
+
+def baseline_similar_products(df, embeddings, product_id, num_similar_products, min_score):
+    """Búsqueda original: un IndexFlatIP por (clúster, tienda) y k + 1 vecinos en cada uno"""
+    row = df.index[df['product_id'] == product_id][0]
+    query_vector = embeddings[row:row + 1]
+    in_cluster = df['cluster_id'] == df['cluster_id'].iat[row]
+
+    found = {}
+    for source, group in df[in_cluster].groupby('data_source'):
+        index = faiss.IndexFlatIP(embeddings.shape[1])
+        index.add(embeddings[group.index.to_numpy()])
+        D, I = index.search(query_vector, k=num_similar_products + 1)
+
+        hits = [
+            (group['product_id'].iat[label], score)
+            for label, score in zip(I[0], D[0])
+            if label >= 0 and group['product_id'].iat[label] != product_id and score >= min_score
+        ]
+        found[source] = hits[:num_similar_products]
+    return found
+
+
+def by_source(similar_products):
+    """Agrupa un resultado de get_similar_products en (product_id, score) por tienda"""
+    return {
+        source: list(zip(group['product_id'], group['score']))
+        for source, group in similar_products.groupby('data_source')
+    }
+
+
+def assert_same_hits(found, expected):
+    for source in set(found) | set(expected):
+        hits, expected_hits = found.get(source, []), expected.get(source, [])
+        assert [product_id for product_id, _ in hits] == [product_id for product_id, _ in expected_hits]
+        np.testing.assert_allclose([score for _, score in hits], [score for _, score in expected_hits], rtol=1e-6)
+
+
+@pytest.mark.parametrize('num_similar_products', [1, 5, 20])
+@pytest.mark.parametrize('min_score', [-1.0, 0.0, 0.3])
+def test_similar_products_match_per_source_flat_search(catalog, num_similar_products, min_score):
+    df, embeddings = catalog
+    engine = ProductSearchEngine()
+    engine.prepare(df, embeddings)
+    engine.build_indexes()
+
+    # Un clúster con un solo índice y otro con un índice por tienda
+    assert engine.get_cached_index(0)['index'] is not None
+    assert engine.get_cached_index(1)['source_indexes'] is not None
+
+    product_ids = df['product_id'].iloc[::7].tolist()
+    batch = engine.get_similar_products_batch(product_ids, num_similar_products, min_score)
+
+    for product_id in product_ids:
+        expected = baseline_similar_products(df, embeddings, product_id, num_similar_products, min_score)
+        single = engine._search_similar_products(product_id, num_similar_products, min_score)
+
+        assert_same_hits(by_source(single), expected)
+        assert batch[product_id]['product_id'].tolist() == single['product_id'].tolist()
+
+
+def test_small_stores_stay_reachable_in_hnsw_clusters(catalog, monkeypatch):
+    df, embeddings = catalog
+    # Con este umbral la tienda A del clúster 1 usa HNSW y las demás un índice exhaustivo
+    monkeypatch.setattr(search_engine, 'HNSW_MIN_CLUSTER_SIZE', 150)
+    engine = ProductSearchEngine()
+    engine.prepare(df, embeddings)
+    engine.build_indexes()
+
+    cluster = engine.get_cached_index(1)
+    assert any(hasattr(index, 'hnsw') for index in cluster['source_indexes'])
+
+    for product_id in df.loc[df['cluster_id'] == 1, 'product_id'].iloc[::11]:
+        expected = baseline_similar_products(df, embeddings, product_id, 5, -1.0)
+        found = by_source(engine.get_similar_products(product_id, 5, -1.0))
+
+        # Las tiendas pequeñas se buscan de forma exhaustiva
+        for source in set(expected) - {'A'}:
+            assert [hit[0] for hit in found.get(source, [])] == [hit[0] for hit in expected[source]]
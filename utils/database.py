@@ -1,47 +1,209 @@
+import hashlib
+import os
+import re
+import faiss
+import numpy as np
 import pandas as pd
-from pymongo import MongoClient
+import pyarrow as pa
+from bson import Binary
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
 import streamlit as st
 
+# Campo con el vector y campos de metadatos que se cargan de la colección de embeddings
+EMBEDDING_FIELD = 'normalized_embeddings'
+EMBEDDING_METADATA_FIELDS = ('product_id', 'cluster_id', 'data_source')
+
+# Tipos BSON con los que se puede guardar un embedding (los nulos no se cargan)
+EMBEDDING_TYPES = ['binData', 'array', 'string']
+
+# Caracteres que se eliminan de los embeddings guardados como string
+_STRIP = str.maketrans('', '', '[]\n')
+
+# Documentos por bloque al convertir productos a tablas de Arrow
+PRODUCTS_BATCH_SIZE = 5000
+
+# Documentos por bloque al leer embeddings (cursor y parseo de los guardados como string)
+EMBEDDINGS_BATCH_SIZE = 1000
+
+# Campos de producto usados para mostrar los resultados
+DISPLAY_FIELDS = ('product_id', 'product_name', 'product_desc', 'sale_price', 'data_source', 'url', 'image')
+
+# Idioma del índice de texto sobre product_name (palabras vacías y raíces en español)
+TEXT_SEARCH_LANGUAGE = 'spanish'
+
+# Columnas de texto que se guardan como strings de Arrow
+STRING_COLUMNS = ('product_id', 'product_name', 'data_source', 'url', 'image', 'product_desc')
+
+# Opciones por defecto de MongoClient: pool de conexiones y compresión del protocolo
+DEFAULT_CLIENT_OPTIONS = {
+    'maxPoolSize': 50,
+    'compressors': 'zstd,zlib',
+}
+
+
+def _parse_embedding(value):
+    """
+    Convierte un embedding almacenado en MongoDB a un array de numpy float32.
+
+    Args:
+        value (bytes | list | str): Embedding como BSON Binary (float32 little-endian),
+            lista de floats o representación en string de un array de numpy.
+
+    Returns:
+        np.ndarray: Vector float32 de una dimensión.
+    """
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype='<f4')
+    if isinstance(value, str):
+        return np.fromstring(value.translate(_STRIP), sep=' ', dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def _write_text_embeddings(matrix, rows, texts):
+    """
+    Parsea un bloque de embeddings guardados como string y los escribe en la matriz.
+
+    Los strings se unen en un solo buffer y se parsean con una única llamada a
+    np.fromstring. Al terminar se vacían las listas rows y texts.
+
+    Args:
+        matrix (np.ndarray): Matriz (N, D) float32 de destino
+        rows (list): Filas de la matriz que corresponden a cada string
+        texts (list): Embeddings en formato string
+    """
+    if not texts:
+        return
+    values = np.fromstring(' '.join(text.translate(_STRIP) for text in texts), sep=' ', dtype=np.float32)
+    matrix[rows] = values.reshape(len(rows), -1)
+    rows.clear()
+    texts.clear()
+
+
+def _documents_to_table(documents):
+    """
+    Convierte un bloque de documentos de MongoDB a una tabla de Arrow.
+
+    Las columnas son la unión de los campos de todos los documentos del bloque, en el
+    orden en que aparecen; los documentos que no tienen un campo quedan con nulo.
+    (pa.Table.from_pylist toma las columnas solo del primer documento.)
+
+    Args:
+        documents (list): Documentos del bloque
+
+    Returns:
+        pa.Table: Tabla con una fila por documento
+    """
+    fields = {}
+    for document in documents:
+        for field in document:
+            fields.setdefault(field, None)
+
+    return pa.Table.from_pydict({field: [document.get(field) for document in documents] for field in fields})
+
+
+def _to_arrow_strings(df):
+    """
+    Convierte las columnas de texto conocidas a pd.ArrowDtype(pa.string()).
+
+    Las operaciones de texto (contains, ==, nunique) sobre estas columnas usan
+    los kernels de Arrow en lugar de comparar objetos de Python.
+
+    Args:
+        df (pd.DataFrame): DataFrame a convertir; se modifica en el lugar
+
+    Returns:
+        pd.DataFrame: El mismo DataFrame
+    """
+    for column in STRING_COLUMNS:
+        if column not in df.columns:
+            continue
+        try:
+            df[column] = df[column].astype(pd.ArrowDtype(pa.string()))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # La columna tiene valores que no son texto, se deja como está
+            pass
+    return df
+
 
 class MongoDBConnection:
     """Maneja la conexión y consultas a MongoDB"""
 
-    def __init__(self, connection_string, database_name="IPS"):
+    def __init__(self, connection_string, database_name="IPS", **client_options):
         """
         Inicializa la conexión a MongoDB.
 
         Args:
             connection_string (str): String de conexión a MongoDB
             database_name (str): Nombre de la base de datos a usar
+            **client_options: Opciones adicionales para MongoClient; reemplazan a
+                DEFAULT_CLIENT_OPTIONS
         """
         self.connection_string = connection_string
         self.database_name = database_name
+        self.client_options = {**DEFAULT_CLIENT_OPTIONS, **client_options}
         self.client = None
         self.db = None
 
     def connect(self):
         """Establece la conexión a MongoDB"""
         try:
-            self.client = MongoClient(self.connection_string)
+            self.client = MongoClient(self.connection_string, **self.client_options)
             self.db = self.client[self.database_name]
             # Verificar conexión
             self.client.server_info()
+            self.ensure_indexes()
             return True
         except Exception as e:
             st.error(f"Error al conectar a MongoDB: {e}")
             return False
 
+    def ensure_indexes(self):
+        """
+        Crea los índices usados por las consultas si aún no existen.
+
+        create_index es idempotente; si el usuario no tiene permisos para crear
+        índices las consultas siguen funcionando sin ellos.
+        """
+        products_collection = self.db['stores_products_final']
+
+        try:
+            # Índice de texto para la búsqueda por nombre
+            products_collection.create_index([('product_name', 'text')], default_language=TEXT_SEARCH_LANGUAGE)
+        except OperationFailure:
+            pass
+
+        try:
+            # Índice para las consultas por product_id; no es único porque el catálogo puede
+            # tener IDs repetidos y la aplicación solo lee la colección
+            products_collection.create_index([('product_id', 1)])
+        except OperationFailure:
+            pass
+
+        try:
+            # Índices para filtrar por clúster y cruzar con los productos
+            embeddings_collection = self.db['stores_products_embeddings']
+            embeddings_collection.create_index([('cluster_id', 1)])
+            embeddings_collection.create_index([('product_id', 1)])
+        except OperationFailure:
+            pass
+
     def disconnect(self):
         """Cierra la conexión a MongoDB"""
         if self.client:
             self.client.close()
 
-    def get_products(self, limit=None):
+    def get_products(self, limit=None, fields=DISPLAY_FIELDS):
         """
         Obtiene los productos de la colección stores_products_final.
 
+        Los documentos se convierten por bloques a tablas de Arrow y el DataFrame
+        resultante usa columnas respaldadas por Arrow (pd.ArrowDtype).
+
         Args:
             limit (int, optional): Número máximo de documentos a retornar
+            fields (tuple, optional): Campos a retornar de cada producto. Si es None
+                se retornan todos los campos
 
         Returns:
             pd.DataFrame: DataFrame con los productos
@@ -49,70 +211,201 @@ class MongoDBConnection:
         try:
             collection = self.db['stores_products_final']
 
+            # Proyectar solo los campos requeridos, excluyendo el campo _id de MongoDB
+            projection = {field: 1 for field in fields or ()}
+            projection['_id'] = 0
+
             # Crear query
+            cursor = collection.find({}, projection).batch_size(PRODUCTS_BATCH_SIZE)
             if limit:
-                cursor = collection.find().limit(limit)
-            else:
-                cursor = collection.find()
-
-            # Convertir a lista de diccionarios
-            products = list(cursor)
-
-            if not products:
+                cursor = cursor.limit(limit)
+
+            try:
+                tables = []
+                batch = []
+                for product in cursor:
+                    batch.append(product)
+                    if len(batch) == PRODUCTS_BATCH_SIZE:
+                        tables.append(_documents_to_table(batch))
+                        batch = []
+                if batch:
+                    tables.append(_documents_to_table(batch))
+
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Arrow no soporta algún valor (p. ej. ObjectId o tipos mezclados en un campo)
+                cursor = collection.find({}, projection)
+                if limit:
+                    cursor = cursor.limit(limit)
+                df_products = pd.DataFrame(list(cursor))
+
+                if df_products.empty:
+                    st.warning("No se encontraron productos en la base de datos")
+
+                return _to_arrow_strings(df_products)
+
+            if not tables:
                 st.warning("No se encontraron productos en la base de datos")
                 return pd.DataFrame()
 
-            # Convertir a DataFrame
-            df_products = pd.DataFrame(products)
+            # Unir los bloques, unificando los tipos inferidos en cada uno
+            table = pa.concat_tables(tables, promote_options='permissive')
+            df_products = table.to_pandas(types_mapper=pd.ArrowDtype)
 
-            # Eliminar el campo _id de MongoDB si existe
-            if '_id' in df_products.columns:
-                df_products = df_products.drop('_id', axis=1)
-
-            return df_products
+            return _to_arrow_strings(df_products)
 
         except Exception as e:
             st.error(f"Error al obtener productos: {e}")
             return pd.DataFrame()
 
-    def get_embeddings(self, limit=None):
+    def get_embeddings(self, dim=None):
         """
         Obtiene los embeddings de la colección stores_products_embeddings.
 
+        El cursor se recorre en streaming y cada vector se escribe directamente en una
+        matriz float32 preasignada, sin materializar listas de Python por documento.
+        Los embeddings guardados como string se parsean por bloques.
+
         Args:
-            limit (int, optional): Número máximo de documentos a retornar
+            dim (int, optional): Dimensión de los embeddings. Si no se indica se infiere
+                del primer documento.
 
         Returns:
-            pd.DataFrame: DataFrame con los embeddings
+            tuple: (pd.DataFrame, np.ndarray) con los metadatos de cada embedding
+                   (product_id, cluster_id, data_source) y la matriz (N, D) float32.
+                   La fila i de la matriz corresponde a la fila i del DataFrame.
         """
+        empty = (pd.DataFrame(), np.empty((0, dim or 0), dtype=np.float32))
+
         try:
             collection = self.db['stores_products_embeddings']
 
-            # Crear query
-            if limit:
-                cursor = collection.find().limit(limit)
-            else:
-                cursor = collection.find()
-
-            # Convertir a lista de diccionarios
-            embeddings = list(cursor)
-
-            if not embeddings:
+            # Proyectar solo los campos necesarios
+            projection = {'_id': 0, EMBEDDING_FIELD: 1}
+            projection.update({field: 1 for field in EMBEDDING_METADATA_FIELDS})
+
+            cursor = collection.find(
+                {EMBEDDING_FIELD: {'$type': EMBEDDING_TYPES}},
+                projection
+            ).batch_size(EMBEDDINGS_BATCH_SIZE)
+
+            # Tamaño estimado para preasignar la matriz
+            capacity = max(collection.estimated_document_count(), 1)
+            matrix = None
+            metadata = {field: [] for field in EMBEDDING_METADATA_FIELDS}
+            count = 0
+            # Embeddings en string pendientes de parsear
+            pending_rows, pending_texts = [], []
+
+            for i, doc in enumerate(cursor):
+                value = doc[EMBEDDING_FIELD]
+
+                if matrix is None:
+                    vector_dim = dim or _parse_embedding(value).shape[0]
+                    matrix = np.empty((capacity, vector_dim), dtype=np.float32)
+                elif i == matrix.shape[0]:
+                    # El conteo estimado se quedó corto, duplicar la capacidad
+                    _write_text_embeddings(matrix, pending_rows, pending_texts)
+                    grown = np.empty((2 * matrix.shape[0], matrix.shape[1]), dtype=np.float32)
+                    grown[:i] = matrix
+                    matrix = grown
+
+                if isinstance(value, str):
+                    pending_rows.append(i)
+                    pending_texts.append(value)
+                    if len(pending_texts) == EMBEDDINGS_BATCH_SIZE:
+                        _write_text_embeddings(matrix, pending_rows, pending_texts)
+                else:
+                    matrix[i] = _parse_embedding(value)
+
+                for field in EMBEDDING_METADATA_FIELDS:
+                    metadata[field].append(doc.get(field))
+                count = i + 1
+
+            if matrix is None:
                 st.warning("No se encontraron embeddings en la base de datos")
-                return pd.DataFrame()
+                return empty
+
+            _write_text_embeddings(matrix, pending_rows, pending_texts)
 
-            # Convertir a DataFrame
-            df_embeddings = pd.DataFrame(embeddings)
+            # Liberar la capacidad sobrante
+            if count < matrix.shape[0]:
+                matrix = matrix[:count].copy()
 
-            # Eliminar el campo _id de MongoDB si existe
-            if '_id' in df_embeddings.columns:
-                df_embeddings = df_embeddings.drop('_id', axis=1)
+            df_embeddings = _to_arrow_strings(pd.DataFrame(metadata))
 
-            return df_embeddings
+            return df_embeddings, matrix
 
         except Exception as e:
             st.error(f"Error al obtener embeddings: {e}")
-            return pd.DataFrame()
+            return empty
+
+    def get_embedding_matrix(self, dim=None):
+        """
+        Obtiene los embeddings como una matriz float32 contigua normalizada (L2).
+
+        Con los vectores normalizados la similitud coseno se reduce a un único
+        producto matriz-vector (matrix @ q).
+
+        Args:
+            dim (int, optional): Dimensión de los embeddings. Si no se indica se infiere
+                del primer documento.
+
+        Returns:
+            tuple: (pd.DataFrame, np.ndarray) con los metadatos de cada embedding y la
+                   matriz (N, D) float32 con filas de norma 1.
+        """
+        df_embeddings, matrix = self.get_embeddings(dim)
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+        # Normalizar en el mismo buffer con FAISS (las filas en cero se dejan igual)
+        faiss.normalize_L2(matrix)
+
+        return df_embeddings, matrix
+
+    def migrate_embeddings_to_binary(self, batch_size=1000):
+        """
+        Convierte los embeddings guardados como arrays o strings a BSON Binary.
+
+        Cada vector se guarda como bytes float32 little-endian, que get_embeddings
+        lee con np.frombuffer sin tener que decodificar elemento por elemento.
+
+        Args:
+            batch_size (int): Número de actualizaciones por cada bulk_write
+
+        Returns:
+            int: Número de documentos actualizados
+        """
+        try:
+            collection = self.db['stores_products_embeddings']
+
+            # Solo los documentos que aún no están en formato binario (los nulos se dejan igual)
+            cursor = collection.find(
+                {EMBEDDING_FIELD: {'$type': ['array', 'string']}},
+                {EMBEDDING_FIELD: 1}
+            ).batch_size(batch_size)
+
+            updated = 0
+            operations = []
+
+            for doc in cursor:
+                vector = _parse_embedding(doc[EMBEDDING_FIELD]).astype('<f4', copy=False)
+                operations.append(UpdateOne(
+                    {'_id': doc['_id']},
+                    {'$set': {EMBEDDING_FIELD: Binary(vector.tobytes())}}
+                ))
+
+                if len(operations) == batch_size:
+                    updated += collection.bulk_write(operations, ordered=False).modified_count
+                    operations = []
+
+            if operations:
+                updated += collection.bulk_write(operations, ordered=False).modified_count
+
+            return updated
+
+        except Exception as e:
+            st.error(f"Error al migrar embeddings: {e}")
+            return 0
 
     def get_product_by_id(self, product_id):
         """
@@ -137,10 +430,43 @@ class MongoDBConnection:
             st.error(f"Error al obtener producto: {e}")
             return None
 
+    def get_products_by_ids(self, product_ids, fields=DISPLAY_FIELDS):
+        """
+        Obtiene los productos con los IDs dados, proyectando solo los campos indicados.
+
+        Args:
+            product_ids (iterable): IDs de los productos
+            fields (tuple): Campos a retornar de cada producto
+
+        Returns:
+            pd.DataFrame: DataFrame con los productos encontrados; vacío pero con
+                          las columnas de fields si no se encuentra ninguno
+        """
+        try:
+            collection = self.db['stores_products_final']
+
+            projection = {field: 1 for field in fields}
+            projection['_id'] = 0
+
+            cursor = collection.find({'product_id': {'$in': list(product_ids)}}, projection)
+            products = list(cursor)
+
+            if not products:
+                return pd.DataFrame(columns=list(fields))
+
+            return _to_arrow_strings(pd.DataFrame(products))
+
+        except Exception as e:
+            st.error(f"Error al obtener productos: {e}")
+            return pd.DataFrame(columns=list(fields))
+
     def search_products_by_name(self, search_query, limit=20):
         """
         Busca productos por nombre.
 
+        Usa el índice de texto de MongoDB y, si no hay resultados, una expresión
+        regular para coincidencias parciales del nombre.
+
         Args:
             search_query (str): Término de búsqueda
             limit (int): Número máximo de resultados
@@ -151,16 +477,30 @@ class MongoDBConnection:
         try:
             collection = self.db['stores_products_final']
 
-            # Búsqueda con expresión regular (case-insensitive)
-            query = {
-                'product_name': {
-                    '$regex': search_query,
-                    '$options': 'i'
+            # Búsqueda con el índice de texto, ordenada por relevancia. El idioma se indica también
+            # en la consulta, así "de" o "la" no coinciden con todo el catálogo aunque el índice
+            # se haya creado antes en inglés
+            try:
+                cursor = collection.find(
+                    {'$text': {'$search': search_query, '$language': TEXT_SEARCH_LANGUAGE}},
+                    {'text_score': {'$meta': 'textScore'}}
+                ).sort([('text_score', {'$meta': 'textScore'})]).limit(limit)
+                products = list(cursor)
+            except OperationFailure:
+                # No hay índice de texto disponible
+                products = []
+
+            if not products:
+                # Búsqueda con expresión regular (case-insensitive) para coincidencias parciales
+                query = {
+                    'product_name': {
+                        '$regex': re.escape(search_query),
+                        '$options': 'i'
+                    }
                 }
-            }
 
-            cursor = collection.find(query).limit(limit)
-            products = list(cursor)
+                cursor = collection.find(query).limit(limit)
+                products = list(cursor)
 
             if not products:
                 return pd.DataFrame()
@@ -203,6 +543,10 @@ class MongoDBConnection:
         """
         Obtiene todos los productos de un clúster específico.
 
+        El cruce entre embeddings y productos se hace en MongoDB con un único
+        pipeline de agregación ($lookup). Si un campo existe en ambas colecciones
+        se conserva el valor de la colección de embeddings.
+
         Args:
             cluster_id (int): ID del clúster
 
@@ -210,40 +554,103 @@ class MongoDBConnection:
             pd.DataFrame: DataFrame con los productos del clúster
         """
         try:
-            # Primero obtener los product_ids del clúster desde embeddings
-            embeddings_collection = self.db['stores_products_embeddings']
-            embeddings_cursor = embeddings_collection.find({'cluster_id': cluster_id})
-            embeddings = list(embeddings_cursor)
+            pipeline = [
+                {'$match': {'cluster_id': cluster_id}},
+                {'$lookup': {
+                    'from': 'stores_products_final',
+                    'localField': 'product_id',
+                    'foreignField': 'product_id',
+                    'as': 'product'
+                }},
+                # Conservar los embeddings sin producto, como un left join
+                {'$unwind': {'path': '$product', 'preserveNullAndEmptyArrays': True}},
+                {'$replaceRoot': {'newRoot': {'$mergeObjects': ['$product', '$$ROOT']}}},
+                {'$project': {'_id': 0, 'product': 0}}
+            ]
+
+            cursor = self.db['stores_products_embeddings'].aggregate(pipeline, allowDiskUse=True)
+            products = list(cursor)
 
-            if not embeddings:
+            if not products:
                 return pd.DataFrame()
 
-            df_embeddings = pd.DataFrame(embeddings)
+            return pd.DataFrame(products)
 
-            # Obtener los detalles de productos
-            products_collection = self.db['stores_products_final']
-            product_ids = df_embeddings['product_id'].tolist()
+        except Exception as e:
+            st.error(f"Error al obtener productos del clúster: {e}")
+            return pd.DataFrame()
 
-            products_cursor = products_collection.find({
-                'product_id': {'$in': product_ids}
-            })
-            products = list(products_cursor)
 
-            if not products:
-                return pd.DataFrame()
+class EmbeddingCache:
+    """Guarda en disco la matriz de embeddings normalizada para reutilizarla entre reinicios"""
 
-            df_products = pd.DataFrame(products)
+    def __init__(self, cache_dir='.cache'):
+        """
+        Inicializa la caché de embeddings.
 
-            # Eliminar _id si existe
-            for df in [df_embeddings, df_products]:
-                if '_id' in df.columns:
-                    df.drop('_id', axis=1, inplace=True)
+        Args:
+            cache_dir (str): Directorio donde se guardan los archivos de la caché
+        """
+        self.cache_dir = cache_dir
 
-            # Merge embeddings con productos
-            df_result = pd.merge(df_embeddings, df_products, on='product_id', how='left')
+    def get_cache_path(self, mongo_conn):
+        """
+        Obtiene el directorio de la caché para el estado actual de la colección.
 
-            return df_result
+        La clave se calcula a partir de la base de datos, la colección y el número
+        de documentos, por lo que agregar o eliminar embeddings invalida la caché.
 
-        except Exception as e:
-            st.error(f"Error al obtener productos del clúster: {e}")
-            return pd.DataFrame()
\ No newline at end of file
+        Args:
+            mongo_conn (MongoDBConnection): Conexión abierta a MongoDB
+
+        Returns:
+            str: Ruta del directorio de la caché
+        """
+        collection = mongo_conn.db['stores_products_embeddings']
+        key = hashlib.sha1(
+            f"{mongo_conn.database_name}.{collection.name}.{collection.estimated_document_count()}".encode()
+        ).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def load_or_fetch(self, mongo_conn):
+        """
+        Carga los embeddings desde la caché o, si no existe, desde MongoDB.
+
+        La matriz se abre con np.load(mmap_mode='r'), así el sistema operativo carga
+        sus páginas bajo demanda y no hay que deserializarla en cada inicio.
+
+        Args:
+            mongo_conn (MongoDBConnection): Conexión abierta a MongoDB
+
+        Returns:
+            tuple: (pd.DataFrame, np.ndarray) igual que get_embedding_matrix. Si viene
+                   de la caché, la matriz es de solo lectura.
+        """
+        cache_path = self.get_cache_path(mongo_conn)
+        metadata_path = os.path.join(cache_path, 'metadata.parquet')
+        matrix_path = os.path.join(cache_path, 'matrix.npy')
+
+        if os.path.exists(metadata_path) and os.path.exists(matrix_path):
+            df_embeddings = _to_arrow_strings(pd.read_parquet(metadata_path))
+            return df_embeddings, np.load(matrix_path, mmap_mode='r')
+
+        df_embeddings, matrix = mongo_conn.get_embedding_matrix()
+
+        if not df_embeddings.empty:
+            try:
+                os.makedirs(cache_path, exist_ok=True)
+
+                # Escribir en archivos temporales y renombrar, para no dejar archivos incompletos
+                df_embeddings.to_parquet(f"{metadata_path}.tmp", index=False)
+                os.replace(f"{metadata_path}.tmp", metadata_path)
+
+                with open(f"{matrix_path}.tmp", 'wb') as f:
+                    np.save(f, matrix)
+                os.replace(f"{matrix_path}.tmp", matrix_path)
+
+            except (OSError, pa.ArrowException, ValueError, TypeError) as e:
+                # Arrow no puede guardar columnas con tipos mezclados (p. ej. cluster_id int y str);
+                # los embeddings ya están cargados, solo quedan sin caché
+                st.warning(f"No se pudo guardar la caché de embeddings: {e}")
+
+        return df_embeddings, matrix
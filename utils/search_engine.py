@@ -1,125 +1,507 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import faiss
 import numpy as np
 import pandas as pd
-import re
+
+try:
+    from numba import njit
+except ImportError:
+    # Sin numba se usa la versión con NumPy de _select_per_source
+    njit = None
+
+# A partir de este tamaño se usa un índice HNSW en lugar de búsqueda exhaustiva; los clústeres
+# más grandes tienen además un índice por tienda (ver _build_cluster)
+HNSW_MIN_CLUSTER_SIZE = 2000
+
+# Parámetros del grafo HNSW: vecinos por nodo y amplitud de búsqueda al construir y consultar
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+
+# Lectura de índices guardados con mmap sin copia (IO_FLAG_MMAP solo aplica a las listas de
+# los índices IVF); None si la versión de faiss no lo tiene
+INDEX_MMAP_FLAG = getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
+
+# Hilos para construir en paralelo los índices de los clústeres pequeños
+INDEX_BUILD_WORKERS = min(8, os.cpu_count() or 1)
+
+# Columnas de detalles del producto que se agregan a los resultados (si existen en df_products)
+PRODUCT_DETAILS_COLUMNS = (
+    'product_id', 'product_name', 'product_desc', 'sale_price',
+    'category_1_id', 'category_2_id', 'category_3_id',
+    'category_1', 'category_2', 'category_3', 'url', 'image', 'data_source'
+)
+
+# Cantidad máxima de búsquedas recientes que se guardan en memoria
+RESULT_CACHE_SIZE = 1024
+
+
+def _select_per_source_loop(source_ids, valid, sources, k, limit):
+    """
+    Selecciona los resultados de cada tienda a partir de los resultados ordenados de FAISS.
+
+    De los k primeros resultados de cada tienda se dejan los válidos, hasta limit por tienda.
+
+    Args:
+        source_ids (np.ndarray): Código de la tienda de cada resultado, ordenados por puntuación.
+        valid (np.ndarray): Máscara booleana de los resultados que cumplen los filtros.
+        sources (np.ndarray): Códigos de las tiendas, en el orden en que se devuelven.
+        k (int): Cantidad de resultados de cada tienda que se consideran.
+        limit (int): Cantidad máxima de resultados por tienda.
+
+    Returns:
+        np.ndarray: Posiciones de los resultados seleccionados, agrupados por tienda.
+    """
+    selected = np.empty(source_ids.shape[0], dtype=np.int64)
+    n = 0
+    for source_id in sources:
+        seen = 0
+        taken = 0
+        for j in range(source_ids.shape[0]):
+            if source_ids[j] != source_id:
+                continue
+            seen += 1
+            if seen > k or taken == limit:
+                break
+            if valid[j]:
+                selected[n] = j
+                n += 1
+                taken += 1
+    return selected[:n]
+
+
+def _select_per_source_numpy(source_ids, valid, sources, k, limit):
+    """
+    Igual que _select_per_source_loop, con operaciones de NumPy por tienda.
+
+    Sin numba el bucle se ejecutaría en Python puro, que es más lento que esta versión.
+    """
+    selected = []
+    for source_id in sources:
+        top = np.flatnonzero(source_ids == source_id)[:k]
+        selected.append(top[valid[top]][:limit])
+    return np.concatenate(selected)
+
+
+# Con numba el bucle se compila a código nativo (ver _warm_up_kernels)
+_select_per_source = _select_per_source_numpy if njit is None else njit(_select_per_source_loop)
+
+
+def _warm_up_kernels():
+    """
+    Compila las funciones de numba con los tipos de las búsquedas, para que la primera
+    búsqueda no espere la compilación.
+    """
+    if njit is None:
+        return
+    codes = np.zeros(1, dtype=np.int64)
+    _select_per_source(codes, np.ones(1, dtype=np.bool_), codes, 1, 1)
+
+
+def _available_detail_columns(df_products):
+    """
+    Obtiene las columnas de PRODUCT_DETAILS_COLUMNS que existen en un DataFrame de productos.
+
+    Args:
+        df_products (pd.DataFrame): DataFrame con detalles de los productos.
+
+    Returns:
+        list: Nombres de las columnas, en el orden de PRODUCT_DETAILS_COLUMNS.
+    """
+    return [col for col in PRODUCT_DETAILS_COLUMNS if col in df_products.columns]
+
+
+def _first_row_of(product_ids):
+    """
+    Crea un diccionario product_id -> posición de la fila; si un ID está repetido se conserva la primera.
+
+    Args:
+        product_ids (pd.Series): Columna product_id de un DataFrame.
+
+    Returns:
+        dict: Posición (int) de cada product_id.
+    """
+    first = ~product_ids.duplicated()
+    return dict(zip(product_ids[first], np.flatnonzero(first).tolist()))
 
 
 class ProductSearchEngine:
     """Motor de búsqueda de productos similares usando FAISS"""
 
-    def __init__(self):
-        self.clusters_indexes = []
+    def __init__(self, quantize=False, half_precision=False, index_dir=None):
+        """
+        Inicializa el motor de búsqueda.
+
+        Args:
+            quantize (bool, optional): Si True, los índices guardan los embeddings cuantizados a int8
+                (IndexScalarQuantizer), usando 4 veces menos memoria a cambio de puntuaciones
+                aproximadas. Por defecto es False.
+            half_precision (bool, optional): Si True, la matriz de embeddings y los índices (si no se
+                cuantizan a int8) guardan los vectores en float16, usando la mitad de memoria con
+                puntuaciones casi idénticas. Por defecto es False.
+            index_dir (str, optional): Directorio donde se guardan los índices FAISS para reutilizarlos
+                entre reinicios. Debe ser distinto para cada versión de los embeddings. Por defecto es
+                None (los índices solo se mantienen en memoria).
+        """
+        self.quantize = quantize
+        self.half_precision = half_precision
+        self.index_dir = index_dir
+        # Índices FAISS por ID de clúster (ver _build_cluster)
+        self.clusters_indexes = {}
+        self._df = None
+        self._emb = None
+        self._row_of = {}
+        self._products = None
+        self._product_row_of = {}
+        self._product_columns = []
+        self._source_codes = None
+        self._product_codes = None
+        self._cluster_rows = {}
+        # Resultados recientes de get_similar_products, del menos al más usado
+        self._result_cache = OrderedDict()
+        self._result_cache_lock = threading.Lock()
+
+    def prepare(self, df, embeddings, df_products=None):
+        """
+        Registra los datos con los que trabaja el motor. Se llama una vez al cargar los datos.
+
+        Los embeddings ya llegan parseados desde MongoDB, así que las búsquedas solo toman
+        filas de la matriz por posición.
+
+        Args:
+            df (pd.DataFrame): DataFrame con información de productos y clústeres.
+            embeddings (np.ndarray): Matriz (N, D) con los embeddings normalizados,
+                alineada por posición con las filas de df.
+            df_products (pd.DataFrame, optional): DataFrame con los detalles de los productos. Si se
+                indica, add_product_details lo busca por diccionario en lugar de recorrerlo.
+        """
+        self._df = df
+        if self.half_precision:
+            # Copia en float16; se convierte a float32 solo al pasar vectores a FAISS
+            self._emb = np.ascontiguousarray(embeddings, dtype=np.float16)
+        else:
+            # FAISS necesita float32 contiguo (no copia si ya lo es)
+            self._emb = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+        # Fila de cada producto en la matriz y en df_products
+        self._row_of = _first_row_of(df['product_id'])
+        self._products = df_products
+        self._product_row_of = {} if df_products is None else _first_row_of(df_products['product_id'])
+        self._product_columns = [] if df_products is None else _available_detail_columns(df_products)
+
+        # Código entero de la fuente de datos de cada fila, en orden alfabético (-1 si no tiene)
+        self._source_codes = pd.factorize(df['data_source'], sort=True)[0]
+
+        # Código entero del product_id de cada fila (las filas repetidas comparten código, -1 si no tiene)
+        self._product_codes = pd.factorize(df['product_id'])[0]
+
+        # Posiciones de las filas de cada clúster, calculadas en una sola pasada
+        self._cluster_rows = df.groupby('cluster_id').indices
+
+        # Los resultados guardados corresponden a los datos anteriores
+        with self._result_cache_lock:
+            self._result_cache.clear()
+
+    def _vectors(self, rows):
+        """
+        Obtiene filas de la matriz de embeddings como float32 contiguo, listas para FAISS.
+
+        Args:
+            rows (np.ndarray | slice): Posiciones de las filas en la matriz.
+
+        Returns:
+            np.ndarray: Matriz (n, D) float32 (sin copia si la matriz ya es float32).
+        """
+        return np.ascontiguousarray(self._emb[rows], dtype=np.float32)
 
-    def get_cached_index(self, cluster_id, source_cluster):
+    def get_cached_index(self, cluster_id):
         """
-        Busca un índice FAISS cacheado para un ID de clúster y fuente de datos dados.
+        Busca el índice FAISS cacheado de un ID de clúster dado.
 
         Args:
             cluster_id (int): El ID del clúster.
-            source_cluster (str): La fuente de datos del clúster.
 
         Returns:
-            faiss.Index: El índice FAISS cacheado si se encuentra, de lo contrario None.
+            dict: El índice del clúster (ver _build_cluster) si se encuentra, de lo contrario None.
         """
-        for cluster in self.clusters_indexes:
-            if cluster['cluster_id'] == cluster_id and cluster['source'] == source_cluster:
-                return cluster['index']
-        return None
+        return self.clusters_indexes.get(cluster_id)
 
-    def get_product_cluster(self, df, product_id):
+    def _build_index(self, cluster_embeddings):
         """
-        Obtiene el clúster al que pertenece un producto dado y el DataFrame de productos dentro de ese clúster.
+        Crea un índice FAISS de producto interno con los embeddings dados.
+
+        Los clústeres con más de HNSW_MIN_CLUSTER_SIZE productos usan un índice HNSW
+        (búsqueda aproximada); los demás se recorren de forma exhaustiva.
 
         Args:
-            df (pd.DataFrame): DataFrame con información de productos y clústeres.
-            product_id (str): El ID del producto.
+            cluster_embeddings (np.ndarray): Matriz (n, D) float32 con los embeddings normalizados.
 
         Returns:
-            tuple: Una tupla que contiene el DataFrame del clúster del producto, la fila del producto y el ID del clúster.
-                   Retorna (None, None, None) si el producto no se encuentra.
+            faiss.Index: El índice con los embeddings agregados.
         """
-        product = df[df['product_id'] == product_id]
-        if product.empty:
-            return None, None, None
+        # FAISS copiaría en cada add/train una matriz que no sea float32 contigua
+        cluster_embeddings = np.ascontiguousarray(cluster_embeddings, dtype=np.float32)
+
+        size, dimension = cluster_embeddings.shape
+        use_hnsw = size > HNSW_MIN_CLUSTER_SIZE
+
+        if self.quantize or self.half_precision:
+            # Cuantización escalar a 8 bits por dimensión entrenada con los embeddings del clúster,
+            # o almacenamiento en float16
+            qtype = faiss.ScalarQuantizer.QT_8bit if self.quantize else faiss.ScalarQuantizer.QT_fp16
+            if use_hnsw:
+                index = faiss.IndexHNSWSQ(dimension, qtype, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            else:
+                index = faiss.IndexScalarQuantizer(dimension, qtype, faiss.METRIC_INNER_PRODUCT)
+        elif use_hnsw:
+            index = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexFlatIP(dimension)
+
+        if use_hnsw:
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+
+        if not index.is_trained:
+            index.train(cluster_embeddings)
 
-        cluster_id = product['cluster_id'].values[0]
-        df_clusters = df[df['cluster_id'] == cluster_id]
-        return df_clusters, product, cluster_id
+        index.add(cluster_embeddings)
+        return index
 
-    def get_clusters_group_by_source(self, df):
+    def _index_path(self, cluster_id, source=None):
         """
-        Agrupa un DataFrame de clústeres por fuente de datos.
+        Obtiene la ruta del archivo del índice FAISS de un clúster.
 
         Args:
-            df (pd.DataFrame): DataFrame con información de clústeres.
+            cluster_id (int): El ID del clúster.
+            source (int, optional): Código de la tienda, si el índice es de una sola tienda.
+                Por defecto es None (índice de todo el clúster).
 
         Returns:
-            pd.core.groupby.generic.DataFrameGroupBy: Un objeto DataFrameGroupBy agrupado por 'data_source'.
+            str: Ruta del archivo, o None si no se guardan índices en disco.
         """
-        groups = df.groupby('data_source')
-        return groups
+        if self.index_dir is None:
+            return None
+
+        # El tipo de almacenamiento forma parte del nombre para no mezclar índices
+        storage = 'sq8' if self.quantize else 'fp16' if self.half_precision else 'flat'
+        if source is None:
+            return os.path.join(self.index_dir, f"{storage}_cluster_{cluster_id}.faiss")
+        return os.path.join(self.index_dir, f"{storage}_cluster_{cluster_id}_source_{source}.faiss")
 
-    def get_cluster_group_by_source(self, df, product_id):
+    def _load_or_build_index(self, cluster_id, rows, source=None):
         """
-        Obtiene los grupos de clústeres por fuente de datos para el clúster de un producto dado.
+        Abre el índice FAISS de un clúster desde disco o, si no existe, lo construye y lo guarda.
+
+        El archivo se abre con faiss.IO_FLAG_MMAP_IFC, así el sistema operativo carga los
+        vectores bajo demanda y los comparte entre procesos. Con versiones de faiss sin ese
+        flag el archivo se leería completo a memoria, así que solo se guardan los índices HNSW,
+        que tardan en construirse; los exhaustivos se copian de la matriz de embeddings.
+
+        Args:
+            cluster_id (int): El ID del clúster.
+            rows (np.ndarray): Posiciones en df de los productos que forman el índice.
+            source (int, optional): Código de la tienda, si el índice es de una sola tienda.
+                Por defecto es None.
+
+        Returns:
+            faiss.Index: El índice del clúster.
+        """
+        path = self._index_path(cluster_id, source)
+        if INDEX_MMAP_FLAG is None and rows.size <= HNSW_MIN_CLUSTER_SIZE:
+            path = None
+
+        if path is not None and os.path.exists(path):
+            try:
+                index = faiss.read_index(path, INDEX_MMAP_FLAG or 0)
+                # Descartar archivos que no corresponden a los embeddings actuales
+                if index.ntotal == rows.size and index.d == self._emb.shape[1]:
+                    if hasattr(index, 'hnsw'):
+                        index.hnsw.efSearch = HNSW_EF_SEARCH
+                    return index
+            except RuntimeError:
+                pass
+
+        index = self._build_index(self._vectors(rows))
+
+        if path is not None:
+            try:
+                os.makedirs(self.index_dir, exist_ok=True)
+                # Escribir en un archivo temporal y renombrar, para no dejar archivos incompletos
+                faiss.write_index(index, f"{path}.tmp")
+                os.replace(f"{path}.tmp", path)
+            except (OSError, RuntimeError):
+                # Guardar el índice es opcional; se sigue con el que está en memoria
+                pass
+
+        return index
+
+    def _build_cluster(self, cluster_id, rows):
+        """
+        Crea los índices FAISS de un clúster.
+
+        Los clústeres de hasta HNSW_MIN_CLUSTER_SIZE productos tienen un solo índice exhaustivo
+        con todas sus fuentes de datos. Los más grandes tienen un índice por fuente de datos:
+        en un solo grafo HNSW los productos de una tienda pequeña pueden quedar fuera del
+        alcance de la búsqueda, mientras que en su propio índice siempre se encuentran.
+
+        Args:
+            cluster_id (int): El ID del clúster.
+            rows (np.ndarray): Posiciones en df de los productos del clúster.
+
+        Returns:
+            dict: 'index' con el índice FAISS de todo el clúster (None si tiene un índice por
+                  fuente de datos), 'source_indexes' con el índice de cada fuente de datos (None
+                  si tiene un solo índice), 'rows' con la posición en df de cada vector,
+                  'source_ids' con el código de la fuente de datos de cada vector,
+                  'sources' con los códigos de las fuentes presentes, ordenados,
+                  'source_sizes' con la cantidad de productos de cada una y 'source_starts'
+                  con la posición en 'rows' del primer vector de cada una.
+        """
+        # Los productos sin fuente de datos no se indexan
+        rows = rows[self._source_codes[rows] >= 0]
+        source_ids = self._source_codes[rows]
+        split_by_source = rows.size > HNSW_MIN_CLUSTER_SIZE
+
+        if split_by_source:
+            # Las filas de cada fuente de datos quedan contiguas, en el orden de 'sources'
+            order = np.argsort(source_ids, kind='stable')
+            rows, source_ids = rows[order], source_ids[order]
+
+        sources, source_starts, source_sizes = np.unique(source_ids, return_index=True, return_counts=True)
+
+        index = source_indexes = None
+        if split_by_source:
+            source_indexes = [
+                self._load_or_build_index(cluster_id, rows[start:start + size], source)
+                for source, start, size in zip(sources, source_starts, source_sizes)
+            ]
+        elif rows.size:
+            index = self._load_or_build_index(cluster_id, rows)
+
+        return {
+            'index': index,
+            'source_indexes': source_indexes,
+            'rows': rows,
+            'source_ids': source_ids,
+            'sources': sources,
+            'source_sizes': source_sizes,
+            'source_starts': source_starts
+        }
+
+    def build_indexes(self):
+        """
+        Construye por adelantado los índices FAISS de todos los clústeres.
+
+        Se llama una vez después de prepare, de modo que cada búsqueda solo consulta
+        índices ya construidos. FAISS libera el GIL al agregar vectores, así que los
+        clústeres pequeños se construyen en varios hilos; los índices HNSW ya usan
+        todos los núcleos (OpenMP), así que los clústeres grandes se construyen de a uno.
+        """
+        pending = [
+            (cluster_id, rows) for cluster_id, rows in self._cluster_rows.items()
+            if self.get_cached_index(cluster_id) is None
+        ]
+        small = [item for item in pending if len(item[1]) <= HNSW_MIN_CLUSTER_SIZE]
+        large = [item for item in pending if len(item[1]) > HNSW_MIN_CLUSTER_SIZE]
+
+        with ThreadPoolExecutor(max_workers=INDEX_BUILD_WORKERS) as executor:
+            clusters = executor.map(lambda item: self._build_cluster(*item), small)
+            for (cluster_id, _), cluster in zip(small, clusters):
+                self.clusters_indexes[cluster_id] = cluster
+
+        for cluster_id, rows in large:
+            self.clusters_indexes[cluster_id] = self._build_cluster(cluster_id, rows)
+
+        _warm_up_kernels()
+
+    def get_product_cluster(self, product_id):
+        """
+        Obtiene el clúster al que pertenece un producto dado.
 
         Args:
-            df (pd.DataFrame): DataFrame con información de productos y clústeres.
             product_id (str): El ID del producto.
 
         Returns:
-            list: Una lista de diccionarios, cada uno conteniendo el índice FAISS, la fuente de datos y el DataFrame del clúster.
-            product: La fila del producto.
-                  Retorna None si no se encuentra el clúster del producto.
+            tuple: Una tupla que contiene la fila del producto y el ID del clúster.
+                   Retorna (None, None) si el producto no se encuentra.
+        """
+        row = self._row_of.get(product_id)
+        if row is None:
+            return None, None
+
+        return self._df.iloc[row:row + 1], self._df['cluster_id'].iat[row]
+
+    def get_cluster_index(self, product_id):
         """
-        product_cluster, product, cluster_id = self.get_product_cluster(df, product_id)
+        Obtiene el índice FAISS del clúster de un producto dado, construyéndolo si no está cacheado.
 
-        if product_cluster is None:
+        Args:
+            product_id (str): El ID del producto.
+
+        Returns:
+            tuple: El índice del clúster (ver _build_cluster) y la fila del producto.
+                   Retorna (None, None) si no se encuentra el clúster del producto.
+        """
+        product, cluster_id = self.get_product_cluster(product_id)
+
+        if product is None:
             return None, None
 
-        df_by_source = self.get_clusters_group_by_source(product_cluster)
-        index_group = []
+        cluster = self.get_cached_index(cluster_id)
 
-        for cluster_source in df_by_source.groups:
-            source_product_cluster = df_by_source.get_group(cluster_source)
+        if cluster is None:
+            rows = self._cluster_rows.get(cluster_id, np.empty(0, dtype=np.intp))
+            cluster = self._build_cluster(cluster_id, rows)
+            self.clusters_indexes[cluster_id] = cluster
 
-            # Convertir la representación de string del embedding a un array de numpy
-            cluster_embeddings = np.array([
-                np.fromstring(re.sub(r'[\[\]\n]', '', embedding), sep=' ')
-                for embedding in source_product_cluster['normalized_embeddings']
-            ])
+        return cluster, product
 
-            index = self.get_cached_index(cluster_id, cluster_source)
+    def _get_cached_result(self, key):
+        """
+        Busca un resultado de get_similar_products en la caché de resultados recientes.
 
-            if index is not None:
-                index_group.append({
-                    'index': index,
-                    'source': cluster_source,
-                    'data': source_product_cluster
-                })
-                continue
+        Args:
+            key (tuple): (product_id, num_similar_products, min_score).
 
-            index = faiss.IndexFlatIP(cluster_embeddings.shape[1])
-            index.add(cluster_embeddings)
-            index_group.append({
-                'index': index,
-                'source': cluster_source,
-                'data': source_product_cluster
-            })
-            self.clusters_indexes.append({
-                'source': cluster_source,
-                'cluster_id': cluster_id,
-                'index': index
-            })
+        Returns:
+            pd.DataFrame: Una copia del resultado guardado, o None si no está.
+        """
+        with self._result_cache_lock:
+            cached = self._result_cache.get(key)
+            if cached is not None:
+                self._result_cache.move_to_end(key)
 
-        return index_group, product
+        return None if cached is None else cached.copy()
 
-    def get_similar_products(self, df, product_id, num_similar_products=10, min_score=0.5):
+    def _cache_result(self, key, similar_products):
+        """
+        Guarda un resultado en la caché de resultados recientes, descartando el menos usado.
+
+        Args:
+            key (tuple): (product_id, num_similar_products, min_score).
+            similar_products (pd.DataFrame): El resultado; None no se guarda.
+        """
+        if similar_products is None:
+            return
+
+        with self._result_cache_lock:
+            self._result_cache[key] = similar_products.copy()
+            if len(self._result_cache) > RESULT_CACHE_SIZE:
+                self._result_cache.popitem(last=False)
+
+    def get_similar_products(self, product_id, num_similar_products=10, min_score=0.5):
         """
         Busca productos similares a un producto dado utilizando FAISS dentro de su clúster.
 
+        Se hace una sola búsqueda sobre el índice del clúster y los resultados se reparten
+        por tienda (data_source), devolviendo hasta num_similar_products por tienda. En los
+        clústeres con un índice por tienda se busca en cada uno.
+
         Args:
-            df (pd.DataFrame): DataFrame con información de productos y embeddings normalizados.
             product_id (str): El ID del producto.
             num_similar_products (int, optional): El número máximo de productos similares a encontrar. Por defecto es 10.
             min_score (float, optional): La puntuación mínima de similitud para considerar un producto similar. Por defecto es 0.5.
@@ -128,57 +510,250 @@ class ProductSearchEngine:
             pd.DataFrame: Un DataFrame con los productos similares encontrados, incluyendo su puntuación de similitud.
                         Retorna None si no se encuentra el clúster del producto.
         """
-        # Obtener clusters agrupados por tiendas (data_source)
-        cluster_groups, product = self.get_cluster_group_by_source(df, product_id)
+        # Los productos populares se consultan muchas veces con los mismos parámetros
+        key = (product_id, num_similar_products, min_score)
 
-        if cluster_groups is None:
-            return None
+        similar_products = self._get_cached_result(key)
+        if similar_products is not None:
+            return similar_products
+
+        similar_products = self._search_similar_products(product_id, num_similar_products, min_score)
+        self._cache_result(key, similar_products)
+
+        return similar_products
+
+    def get_similar_products_batch(self, product_ids, num_similar_products=10, min_score=0.5):
+        """
+        Busca productos similares para varios productos a la vez.
+
+        Los productos se agrupan por clúster y cada índice FAISS recibe todas sus consultas
+        en una sola llamada (matriz de B vectores). El resultado de cada producto es el
+        mismo que daría get_similar_products.
+
+        Args:
+            product_ids (list): Lista de IDs de productos.
+            num_similar_products (int, optional): El número máximo de productos similares a encontrar. Por defecto es 10.
+            min_score (float, optional): La puntuación mínima de similitud para considerar un producto similar. Por defecto es 0.5.
 
-        # Buscar similares
-        products_found = []
+        Returns:
+            dict: product_id -> pd.DataFrame con los productos similares (o None si no se
+                  encuentra el clúster del producto), igual que get_similar_products.
+        """
+        results = {}
+        pending_by_cluster = {}
 
-        for cluster in cluster_groups:
-            index = cluster['index']
-            df_cluster_data = cluster['data']
+        for product_id in product_ids:
+            if product_id in results:
+                continue
 
-            query_vector = np.array([
-                np.fromstring(
-                    re.sub(r'[\[\]\n]', '', df.loc[df['product_id'] == product_id, 'normalized_embeddings'].values[0]),
-                    sep=' '
-                )
-            ])
+            key = (product_id, num_similar_products, min_score)
+            results[product_id] = self._get_cached_result(key)
+            if results[product_id] is not None:
+                continue
 
-            k = num_similar_products + 1
-            D, I = index.search(query_vector, k=k)
+            cluster, product = self.get_cluster_index(product_id)
+            if cluster is None:
+                continue
 
-            # Obtener resultados
-            similar_products = df_cluster_data.iloc[I[0]].copy()
-            similar_products['score'] = D[0]
+            if not cluster['rows'].size:
+                results[product_id] = pd.DataFrame()
+            else:
+                pending_by_cluster.setdefault(id(cluster), (cluster, []))[1].append(product_id)
 
-            # Convertir score a tipo float para mejorar precisión en filtro
-            similar_products['score'] = similar_products['score'].astype(float)
+        k = num_similar_products + 1
 
-            # Sacar producto que se está buscando de la lista
-            similar_products = similar_products[similar_products['product_id'] != product_id]
+        for cluster, cluster_product_ids in pending_by_cluster.values():
+            rows = np.array([self._row_of[product_id] for product_id in cluster_product_ids], dtype=np.intp)
+            search_k = None
 
-            # Sacar productos que no tienen score mínimo
-            similar_products = similar_products[similar_products['score'] >= min_score]
+            # Una sola búsqueda con todos los vectores de consulta del clúster (o de cada tienda)
+            if cluster['index'] is None:
+                D, I = self._search_by_source(cluster, self._vectors(rows), k)
+            else:
+                search_k = self._initial_search_k(cluster, k)
+                D, I = cluster['index'].search(self._vectors(rows), k=search_k)
 
-            # Ordenar productos por puntuación
-            similar_products = similar_products.sort_values(by='score', ascending=False)
+            for product_id, row, distances, labels in zip(cluster_product_ids, rows, D, I):
+                labels, scores, source_ids = self._split_hits(cluster, distances, labels)
 
-            # Asegurarse de retornar solo la cantidad requerida por tienda
-            similar_products = similar_products.head(num_similar_products)
-            products_found.append(similar_products)
+                if self._hits_complete(cluster, search_k, scores, source_ids, k, min_score):
+                    similar_products = self._hits_to_frame(
+                        cluster, row, labels, scores, source_ids, k, num_similar_products, min_score
+                    )
+                else:
+                    # Esta consulta necesita más vecinos: se amplía por separado
+                    similar_products = self._search_similar_products(product_id, num_similar_products, min_score)
 
-        if products_found:
-            return pd.DataFrame(pd.concat(products_found))
-        else:
+                results[product_id] = similar_products
+                self._cache_result((product_id, num_similar_products, min_score), similar_products)
+
+        return results
+
+    def _initial_search_k(self, cluster, k):
+        """
+        Calcula la cantidad de vecinos de la primera búsqueda en el índice de un clúster.
+
+        Args:
+            cluster (dict): El índice del clúster (ver _build_cluster).
+            k (int): Cantidad de resultados que se necesitan por tienda.
+
+        Returns:
+            int: k por cada tienda del clúster, sin superar el tamaño del índice.
+        """
+        return min(cluster['index'].ntotal, k * len(cluster['sources']))
+
+    def _search_by_source(self, cluster, vectors, k):
+        """
+        Busca k vecinos en el índice de cada fuente de datos de un clúster.
+
+        En los índices HNSW (fuentes de datos con más de HNSW_MIN_CLUSTER_SIZE productos)
+        la búsqueda es aproximada; en los demás es exhaustiva.
+
+        Args:
+            cluster (dict): El índice del clúster (ver _build_cluster), con 'source_indexes'.
+            vectors (np.ndarray): Matriz (B, D) float32 con los vectores de consulta.
+            k (int): Cantidad de resultados que se necesitan por tienda.
+
+        Returns:
+            tuple: (D, I) como index.search, con los resultados de cada tienda uno a
+                   continuación del otro y las posiciones referidas a cluster['rows'].
+        """
+        distances, labels = [], []
+        for index, start in zip(cluster['source_indexes'], cluster['source_starts']):
+            D, I = index.search(vectors, k=min(k, index.ntotal))
+            distances.append(D)
+            labels.append(np.where(I >= 0, I + start, -1))
+
+        return np.concatenate(distances, axis=1), np.concatenate(labels, axis=1)
+
+    def _split_hits(self, cluster, distances, labels):
+        """
+        Separa los resultados válidos de una consulta a FAISS y su tienda.
+
+        Args:
+            cluster (dict): El índice del clúster (ver _build_cluster).
+            distances (np.ndarray): Puntuaciones devueltas por FAISS para una consulta.
+            labels (np.ndarray): Posiciones en el índice devueltas por FAISS para una consulta.
+
+        Returns:
+            tuple: (labels, scores, source_ids) sin las posiciones -1, que FAISS devuelve
+                   cuando no encuentra suficientes vecinos.
+        """
+        found = labels >= 0
+        labels, scores = labels[found], distances[found]
+        return labels, scores, cluster['source_ids'][labels]
+
+    def _hits_complete(self, cluster, search_k, scores, source_ids, k, min_score):
+        """
+        Indica si los resultados de una consulta alcanzan para todas las tiendas.
+
+        Alcanzan si cada tienda tiene k resultados, si se recorrió todo el clúster o si los
+        productos que faltan quedan por debajo del score mínimo. Si el clúster tiene un índice
+        por tienda siempre alcanzan, porque en cada uno ya se pidieron k vecinos.
+
+        Args:
+            cluster (dict): El índice del clúster (ver _build_cluster).
+            search_k (int): Cantidad de vecinos pedidos a FAISS (None si se buscó por tienda).
+            scores (np.ndarray): Puntuaciones ordenadas de los resultados.
+            source_ids (np.ndarray): Código de la tienda de cada resultado.
+            k (int): Cantidad de resultados que se necesitan por tienda.
+            min_score (float): La puntuación mínima de similitud.
+
+        Returns:
+            bool: True si no hace falta ampliar la búsqueda.
+        """
+        if cluster['index'] is None:
+            return True
+
+        sources = cluster['sources']
+        # Las tiendas pequeñas pueden tener menos de k productos
+        needed = np.minimum(cluster['source_sizes'], k)
+        counts = np.bincount(source_ids, minlength=sources[-1] + 1)[sources]
+
+        return bool(
+            search_k >= cluster['index'].ntotal or (counts >= needed).all()
+            or (scores.size and float(scores[-1]) < min_score)
+        )
+
+    def _hits_to_frame(self, cluster, row, labels, scores, source_ids, k, num_similar_products, min_score):
+        """
+        Filtra los resultados de una consulta y crea el DataFrame de productos similares.
+
+        Args:
+            cluster (dict): El índice del clúster (ver _build_cluster).
+            row (int): Fila del producto buscado.
+            labels (np.ndarray): Posiciones en el índice de los resultados, ordenados por puntuación.
+            scores (np.ndarray): Puntuaciones de los resultados.
+            source_ids (np.ndarray): Código de la tienda de cada resultado.
+            k (int): Cantidad de resultados de cada tienda que se consideran.
+            num_similar_products (int): El número máximo de productos similares por tienda.
+            min_score (float): La puntuación mínima de similitud.
+
+        Returns:
+            pd.DataFrame: Los productos similares con su puntuación de similitud.
+        """
+        found_rows = cluster['rows'][labels]
+        found_codes = self._product_codes[found_rows]
+        # Convertir score a tipo float para mejorar precisión en filtro
+        scores = scores.astype(float)
+
+        # Sacar el producto que se está buscando (comparando códigos enteros), los que
+        # no tienen ID y los que no tienen score mínimo
+        valid = (scores >= min_score) & (found_codes != self._product_codes[row]) & (found_codes >= 0)
+
+        # Los resultados ya vienen ordenados por puntuación: de los k primeros de cada tienda
+        # se dejan los válidos, hasta la cantidad requerida por tienda
+        selected = _select_per_source(source_ids, valid, cluster['sources'], k, num_similar_products)
+
+        return self._df.iloc[found_rows[selected]].assign(score=scores[selected])
+
+    def _search_similar_products(self, product_id, num_similar_products, min_score):
+        """
+        Busca en FAISS los productos similares a un producto dado, sin usar la caché de resultados.
+
+        Args:
+            product_id (str): El ID del producto.
+            num_similar_products (int): El número máximo de productos similares a encontrar por tienda.
+            min_score (float): La puntuación mínima de similitud.
+
+        Returns:
+            pd.DataFrame: Igual que get_similar_products.
+        """
+        cluster, product = self.get_cluster_index(product_id)
+
+        if cluster is None:
+            return None
+
+        if not cluster['rows'].size:
             return pd.DataFrame()
 
+        # El vector de consulta es el mismo para todas las tiendas
+        row = self._row_of[product_id]
+        query_vector = self._vectors(slice(row, row + 1))
+
+        index = cluster['index']
+        k = num_similar_products + 1
+
+        # Los clústeres grandes se buscan en el índice de cada tienda, sin ampliar la búsqueda
+        if index is None:
+            D, I = self._search_by_source(cluster, query_vector, k)
+            labels, scores, source_ids = self._split_hits(cluster, D[0], I[0])
+            return self._hits_to_frame(cluster, row, labels, scores, source_ids, k, num_similar_products, min_score)
+
+        # Ampliar la búsqueda hasta que los resultados alcancen para todas las tiendas
+        search_k = self._initial_search_k(cluster, k)
+        while True:
+            D, I = index.search(query_vector, k=search_k)
+            labels, scores, source_ids = self._split_hits(cluster, D[0], I[0])
+
+            if self._hits_complete(cluster, search_k, scores, source_ids, k, min_score):
+                break
+            search_k = min(index.ntotal, 2 * search_k)
+
+        return self._hits_to_frame(cluster, row, labels, scores, source_ids, k, num_similar_products, min_score)
+
     def get_similar_products_with_details(
         self,
-        df_embeddings,
         df_products,
         product_id,
         num_similar_products=10,
@@ -191,7 +766,6 @@ class ProductSearchEngine:
         Busca productos similares a un producto dado y devuelve sus detalles.
 
         Args:
-            df_embeddings (pd.DataFrame): DataFrame con información de productos y embeddings normalizados.
             df_products (pd.DataFrame): DataFrame con detalles completos de los productos.
             product_id (str): El ID del producto.
             num_similar_products (int, optional): El número máximo de productos similares a encontrar. Por defecto es 10.
@@ -204,37 +778,75 @@ class ProductSearchEngine:
             pd.DataFrame: Un DataFrame con los detalles de los productos similares encontrados, incluyendo su puntuación de similitud.
                         Retorna None si el producto no se encuentra en df_products.
         """
-        search_product = df_products[df_products['product_id'] == product_id]
+        products_found = self.get_similar_products(product_id, num_similar_products, min_score)
 
-        if search_product.empty:
-            return None
+        return self.add_product_details(
+            products_found,
+            df_products,
+            product_id,
+            only_best_price=only_best_price,
+            sort=sort,
+            ascending=ascending
+        )
 
-        product_name = search_product['product_name'].values[0]
-        products_found = self.get_similar_products(df_embeddings, product_id, num_similar_products, min_score)
+    def add_product_details(
+        self,
+        products_found,
+        df_products,
+        product_id,
+        only_best_price=False,
+        sort=['score', 'sale_price'],
+        ascending=[False, True]
+    ):
+        """
+        Agrega los detalles de los productos a los resultados de get_similar_products.
 
-        if products_found is None or products_found.empty:
-            return pd.DataFrame()
+        Args:
+            products_found (pd.DataFrame): Productos similares con su puntuación de similitud.
+            df_products (pd.DataFrame): DataFrame con detalles de los productos. Basta con que incluya
+                el producto buscado y los productos encontrados.
+            product_id (str): El ID del producto buscado.
+            only_best_price (bool, optional): Si True, solo retorna productos con mejor precio. Por defecto es False.
+            sort (list, optional): Lista de columnas para ordenar los resultados. Por defecto es ['score', 'sale_price'].
+            ascending (list, optional): Lista de booleanos para especificar el orden ascendente o descendente. Por defecto es [False, True].
 
-        # Columnas de detalles del producto a incluir
-        product_details_columns = [
-            'product_id', 'product_name', 'product_desc', 'sale_price',
-            'category_1_id', 'category_2_id', 'category_3_id',
-            'category_1', 'category_2', 'category_3', 'url', 'image', 'data_source'
-        ]
+        Returns:
+            pd.DataFrame: Un DataFrame con los detalles de los productos similares encontrados, incluyendo su puntuación de similitud.
+                        Retorna None si el producto no se encuentra en df_products.
+        """
+        # Posición de cada producto y columnas de detalles de df_products
+        # (las calculadas en prepare si es el mismo DataFrame)
+        if df_products is self._products:
+            row_of = self._product_row_of
+            available_columns = self._product_columns
+        else:
+            row_of = _first_row_of(df_products['product_id'])
+            available_columns = _available_detail_columns(df_products)
 
-        # Filtrar columnas que existen en df_products
-        available_columns = [col for col in product_details_columns if col in df_products.columns]
+        row = row_of.get(product_id)
+        if row is None:
+            return None
+        search_product = df_products.iloc[row:row + 1]
 
-        df_products_details = pd.merge(
-            products_found,
-            df_products[available_columns],
-            on='product_id',
-            how='left',
-            suffixes=('', '_y')
+        if products_found is None or products_found.empty:
+            return pd.DataFrame()
+
+        # Tomar de df_products solo las columnas que no están en los resultados, por posición
+        # (equivale a un merge left: los productos que no están quedan con valores nulos)
+        new_columns = [col for col in available_columns if col not in products_found.columns]
+        positions = np.fromiter(
+            (row_of.get(found_id, -1) for found_id in products_found['product_id']),
+            dtype=np.intp,
+            count=len(products_found)
+        )
+        in_products = positions >= 0
+        details = (
+            df_products.iloc[positions[in_products], df_products.columns.get_indexer(new_columns)]
+            .set_axis(np.flatnonzero(in_products))
+            .reindex(range(len(positions)))
         )
 
-        # Eliminar columnas duplicadas
-        df_products_details = df_products_details.loc[:, ~df_products_details.columns.str.endswith('_y')]
+        df_products_details = pd.concat([products_found.reset_index(drop=True), details], axis=1)
 
         # Reordenar columnas
         final_columns = ['product_id', 'product_name', 'product_desc', 'sale_price',
@@ -259,18 +871,11 @@ class ProductSearchEngine:
         # Ordenar resultados
         df_products_details = df_products_details.sort_values(by=sort, ascending=ascending)
 
-        # Filtrar productos con datos válidos
-        # Eliminar productos sin nombre o con nombre vacío
-        df_products_details = df_products_details[
-            df_products_details['product_name'].notna() &
-            (df_products_details['product_name'] != '') &
-            (df_products_details['product_name'].str.strip() != '')
-        ]
-
-        # Eliminar productos sin precio válido
-        df_products_details = df_products_details[
-            df_products_details['sale_price'].notna() &
-            (df_products_details['sale_price'] > 0)
-        ]
+        # Filtrar productos con datos válidos en una sola máscara:
+        # nombre no vacío (contando espacios) y precio mayor que cero
+        product_name = df_products_details['product_name']
+        sale_price = df_products_details['sale_price']
+        valid = product_name.notna() & product_name.str.strip().ne('') & sale_price.notna() & sale_price.gt(0)
+        df_products_details = df_products_details[valid.to_numpy(dtype=bool, na_value=False)]
 
         return df_products_details
\ No newline at end of file